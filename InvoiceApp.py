@@ -1,7 +1,7 @@
 import streamlit as st
 import pandas as pd
 from datetime import datetime
-from supabase import create_client, Client
+from supabase import create_client, Client, PostgrestAPIError
 import os
 from io import BytesIO
 from reportlab.lib import colors
@@ -10,6 +10,7 @@ from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph,
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
 from reportlab.lib.units import inch
 from reportlab.lib.enums import TA_CENTER, TA_RIGHT, TA_LEFT
+import plotly.express as px
 
 # Page config
 st.set_page_config(page_title="GST Invoice Generator", page_icon="🧾", layout="wide")
@@ -35,26 +36,62 @@ if 'invoice_generated' not in st.session_state:
 # Ensure items is always a list
 if not isinstance(st.session_state.invoice_items, list):
     st.session_state.invoice_items = []
+    st.session_state.invoice_items_df = None
+
+# Line item helpers - keep a DataFrame of the items in session state so reruns that
+# don't change the items reuse it instead of rebuilding it from the list of dicts
+def get_items_df():
+    """Get the invoice items as a DataFrame, building it only when not cached"""
+    if st.session_state.get('invoice_items_df') is None:
+        st.session_state.invoice_items_df = pd.DataFrame.from_records(st.session_state.invoice_items, columns=list(ITEM_LABELS))
+    return st.session_state.invoice_items_df
+
+def add_invoice_item(item):
+    """Append an item to the invoice, dropping the cached DataFrame so the next read rebuilds it"""
+    st.session_state.invoice_items.append(item)
+    st.session_state.invoice_items_df = None
+
+def clear_invoice_items():
+    """Remove all items from the invoice"""
+    st.session_state.invoice_items = []
+    st.session_state.invoice_items_df = None
+
+def start_new_invoice():
+    """Clear the items and the generated invoice so a new invoice can be created"""
+    clear_invoice_items()
+    st.session_state['invoice_generated'] = False
+    for key in ('pdf_buffer', 'current_invoice_number', 'current_invoice_date'):
+        if key in st.session_state:
+            del st.session_state[key]
 
 # Number to words conversion
+ONES = ("", "One", "Two", "Three", "Four", "Five", "Six", "Seven", "Eight", "Nine")
+TENS = ("", "", "Twenty", "Thirty", "Forty", "Fifty", "Sixty", "Seventy", "Eighty", "Ninety")
+TEENS = ("Ten", "Eleven", "Twelve", "Thirteen", "Fourteen", "Fifteen", "Sixteen", "Seventeen", "Eighteen", "Nineteen")
+
+def convert_below_thousand(n):
+    """Convert a number from 0 to 999 to words"""
+    if n == 0:
+        return ""
+    elif n < 10:
+        return ONES[n]
+    elif n < 20:
+        return TEENS[n - 10]
+    elif n < 100:
+        return TENS[n // 10] + (" " + ONES[n % 10] if n % 10 != 0 else "")
+    else:
+        return ONES[n // 100] + " Hundred" + (" " + convert_below_thousand(n % 100) if n % 100 != 0 else "")
+
+@st.cache_resource
+def get_below_thousand_words():
+    """Words for every number from 0 to 999, built once per process"""
+    return tuple(convert_below_thousand(n) for n in range(1000))
+
+# Indian number system groups, largest first
+NUMBER_GROUPS = ((10000000, "Crore"), (100000, "Lakh"), (1000, "Thousand"))
+
 def number_to_words(num):
     """Convert number to Indian number system words"""
-    ones = ["", "One", "Two", "Three", "Four", "Five", "Six", "Seven", "Eight", "Nine"]
-    tens = ["", "", "Twenty", "Thirty", "Forty", "Fifty", "Sixty", "Seventy", "Eighty", "Ninety"]
-    teens = ["Ten", "Eleven", "Twelve", "Thirteen", "Fourteen", "Fifteen", "Sixteen", "Seventeen", "Eighteen", "Nineteen"]
-    
-    def convert_below_thousand(n):
-        if n == 0:
-            return ""
-        elif n < 10:
-            return ones[n]
-        elif n < 20:
-            return teens[n - 10]
-        elif n < 100:
-            return tens[n // 10] + (" " + ones[n % 10] if n % 10 != 0 else "")
-        else:
-            return ones[n // 100] + " Hundred" + (" " + convert_below_thousand(n % 100) if n % 100 != 0 else "")
-    
     if num == 0:
         return "Zero Rupees Only"
     
@@ -62,40 +99,37 @@ def number_to_words(num):
     rupees = int(num)
     paise = round((num - rupees) * 100)
     
-    result = ""
-    
-    # Crores
-    if rupees >= 10000000:
-        crores = rupees // 10000000
-        result += convert_below_thousand(crores) + " Crore "
-        rupees %= 10000000
+    below_thousand = get_below_thousand_words()
+    # Whole amounts under a thousand come straight from the lookup table
+    if not paise and 0 < rupees < 1000:
+        return below_thousand[rupees] + " Rupees Only"
     
-    # Lakhs
-    if rupees >= 100000:
-        lakhs = rupees // 100000
-        result += convert_below_thousand(lakhs) + " Lakh "
-        rupees %= 100000
-    
-    # Thousands
-    if rupees >= 1000:
-        thousands = rupees // 1000
-        result += convert_below_thousand(thousands) + " Thousand "
-        rupees %= 1000
-    
-    # Remaining
-    if rupees > 0:
-        result += convert_below_thousand(rupees)
-    
-    result = result.strip() + " Rupees"
+    parts = []
+    for divisor, name in NUMBER_GROUPS:
+        group, rupees = divmod(rupees, divisor)
+        if group:
+            parts.append(below_thousand[group] + " " + name)
+    if rupees:
+        parts.append(below_thousand[rupees])
+    parts.append("Rupees")
     
     if paise > 0:
-        result += " and " + convert_below_thousand(paise) + " Paise"
+        parts.append("and " + below_thousand[paise] + " Paise")
     
-    return result + " Only"
+    return " ".join(parts) + " Only"
 
 # Database functions
 def get_next_invoice_number():
-    """Get suggested invoice number from database (last invoice + 1)"""
+    """Get the next invoice number from database"""
+    # Atomic server-side counter when the next_invoice_number function is installed (see supabase_setup.sql)
+    try:
+        result = supabase.rpc('next_invoice_number').execute()
+        if result.data:
+            return result.data
+    except Exception:
+        pass
+    
+    # Fallback: last invoice + 1
     try:
         result = supabase.table('invoices').select('invoice_number').order('created_at', desc=True).limit(1).execute()
         if result.data and len(result.data) > 0:
@@ -104,13 +138,11 @@ def get_next_invoice_number():
             try:
                 # Handle formats like INV-00001, BILL-123, etc.
                 import re
-                numbers = re.findall(r'\d+', last_invoice)
-                if numbers:
-                    last_num = int(numbers[-1])
-                    next_num = last_num + 1
-                    # Try to maintain the format
-                    prefix = last_invoice.rsplit(str(last_num), 1)[0]
-                    return f"{prefix}{next_num:05d}"
+                m = re.search(r'\d+(?=\D*$)', last_invoice)
+                if m:
+                    # Increment the last number, keeping the prefix, suffix and zero padding
+                    next_num = int(m.group()) + 1
+                    return last_invoice[:m.start()] + f"{next_num:0{len(m.group())}d}" + last_invoice[m.end():]
             except:
                 pass
         return "INV-00001"
@@ -120,31 +152,90 @@ def get_next_invoice_number():
 def save_customer(customer_data):
     """Save or update customer in database"""
     try:
-        # Check if customer exists
-        result = supabase.table('customers').select('*').eq('name', customer_data['name']).execute()
-        if result.data and len(result.data) > 0:
-            # Update
-            supabase.table('customers').update(customer_data).eq('name', customer_data['name']).execute()
-        else:
-            # Insert
-            supabase.table('customers').insert(customer_data).execute()
+        # Insert or update in one round-trip (needs the unique constraint on customers.name, see supabase_setup.sql)
+        supabase.table('customers').upsert(customer_data, on_conflict='name').execute()
+        get_customers.clear()
         return True
     except Exception as e:
         st.error(f"Error saving customer: {e}")
         return False
 
+@st.cache_data(ttl=60, show_spinner=False)
 def get_customers():
-    """Get all customers from database"""
+    """Get all customers from database (cached, cleared on save); errors are raised so they are not cached"""
+    # Only the fields the customer picker and Customers tab display
+    result = supabase.table('customers').select('name,gstin,billing_address,shipping_address,state').order('name').execute()
+    return result.data if result.data else []
+
+# Invoice History paging; the list only needs these columns, the full row is fetched when an invoice is opened
+HISTORY_PAGE_SIZE = 25
+HISTORY_COLUMNS = 'id,invoice_number,invoice_date,customer_name,customer_gstin,grand_total'
+
+@st.cache_data(ttl=60, show_spinner=False)
+def fetch_invoices(offset, limit, search_term=""):
+    """Get a page of invoice summaries matching the search, newest first, and the total match count (cached, cleared on save/delete)"""
+    def matching(columns, head=None):
+        query = supabase.table('invoices').select(columns, count='exact', head=head)
+        term = search_term.strip()
+        if term:
+            # Search for the term literally: escape ilike's own wildcards and escape character
+            like = term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            # Double-quote the pattern so commas and parentheses in the term aren't read as
+            # separators of PostgREST's or filter; backslashes and quotes are escaped inside it
+            pattern = '"%' + like.replace('\\', '\\\\').replace('"', '\\"') + '%"'
+            query = query.or_(f"invoice_number.ilike.{pattern},customer_name.ilike.{pattern}")
+        return query
+    
+    try:
+        result = matching(HISTORY_COLUMNS).order('created_at', desc=True).range(offset, offset + limit - 1).execute()
+    except PostgrestAPIError as e:
+        # PostgREST rejects a range that starts past the last match (416, PGRST103);
+        # return no rows with the real count so the page can say it is out of range
+        if e.code != 'PGRST103':
+            raise
+        return [], matching('id', head=True).execute().count or 0
+    return result.data or [], result.count or 0
+
+def reset_history_page():
+    """Go back to the first history page, e.g. when the search changes"""
+    st.session_state['history_page'] = 1
+
+@st.cache_data(ttl=60, show_spinner=False)
+def get_invoice(invoice_id):
+    """Get a full invoice row including its items (cached, cleared on save/delete)"""
+    result = supabase.table('invoices').select('*').eq('id', invoice_id).limit(1).execute()
+    return result.data[0] if result.data else None
+
+@st.cache_data(ttl=60, show_spinner=False)
+def invoice_number_exists(invoice_number):
+    """Check whether an invoice number is already used (cached, cleared on save/delete); errors are raised so they are not cached"""
+    result = supabase.table('invoices').select('invoice_number').eq('invoice_number', invoice_number).limit(1).execute()
+    return bool(result.data)
+
+def fetch_invoices_for_month(start_date, end_date):
+    """Get the items and grand total of invoices dated within [start_date, end_date)"""
+    result = supabase.table('invoices').select('items,grand_total').gte('invoice_date', start_date).lt('invoice_date', end_date).execute()
+    return result.data if result.data else []
+
+def fetch_hsn_summary(start_date, end_date):
+    """Get HSN aggregates for [start_date, end_date) from the hsn_monthly_summary database function, or None if it is not installed"""
     try:
-        result = supabase.table('customers').select('*').order('name').execute()
-        return result.data if result.data else []
-    except:
-        return []
+        return supabase.rpc('hsn_monthly_summary', {'start_date': start_date, 'end_date': end_date}).execute().data
+    except Exception:
+        return None
+
+def clear_invoice_cache():
+    """Drop cached invoice reads after the invoices table changes"""
+    fetch_invoices.clear()
+    get_invoice.clear()
+    invoice_number_exists.clear()
+    get_hsn_report.clear()
 
 def save_invoice(invoice_data):
     """Save invoice to database"""
     try:
         supabase.table('invoices').insert(invoice_data).execute()
+        clear_invoice_cache()
         return True
     except Exception as e:
         st.error(f"Error saving invoice: {e}")
@@ -154,23 +245,129 @@ def delete_invoice(invoice_id):
     """Delete invoice from database"""
     try:
         supabase.table('invoices').delete().eq('id', invoice_id).execute()
+        clear_invoice_cache()
         return True
     except Exception as e:
         st.error(f"Error deleting invoice: {e}")
         return False
 
+# Display labels for line-item fields, in table column order
+ITEM_LABELS = {
+    'product_name': 'Product',
+    'hsn_code': 'HSN',
+    'quantity': 'Qty',
+    'rate': 'Rate',
+    'taxable_value': 'Taxable Value',
+    'gst_rate': 'GST%',
+    'tax_amount': 'Tax',
+    'total': 'Total'
+}
+
+# Defaults for line-item fields missing from older invoices
+ITEM_DEFAULTS = {
+    'hsn_code': 'Unknown',
+    'product_name': 'Unknown',
+    'quantity': 0,
+    'taxable_value': 0,
+    'gst_rate': 0,
+    'tax_amount': 0,
+    'total': 0
+}
+
+def summarize_products(names):
+    """Join the first three distinct product names, adding '...' when there are more"""
+    unique_names = pd.unique(names)
+    return ', '.join(unique_names[:3]) + ('...' if len(unique_names) > 3 else '')
+
+def build_hsn_summary(invoices):
+    """Aggregate line items of the given invoices per HSN/SAC code, highest value first"""
+    invoices_df = pd.DataFrame(invoices)
+    items = invoices_df.get('items', pd.Series(dtype=object)).explode().dropna()
+    # Missing fields come back as NaN, which makes quantity a float column; quantities are whole numbers
+    items_df = pd.json_normalize(items.tolist()).reindex(columns=list(ITEM_DEFAULTS)).fillna(ITEM_DEFAULTS).astype({'quantity': 'int64'})
+    
+    hsn_df = items_df.groupby('hsn_code', sort=False).agg(**{
+        'Products': ('product_name', summarize_products),
+        'Total Qty': ('quantity', 'sum'),
+        'Taxable Value': ('taxable_value', 'sum'),
+        'Total Tax': ('tax_amount', 'sum'),
+        'Total Value': ('total', 'sum'),
+        'Avg GST %': ('gst_rate', 'mean')
+    })
+    hsn_df = hsn_df.reset_index().rename(columns={'hsn_code': 'HSN/SAC Code'})
+    return hsn_df.sort_values('Total Value', ascending=False)
+
+# Column names returned by hsn_monthly_summary and their display names
+HSN_COLUMNS = {
+    'hsn_code': 'HSN/SAC Code',
+    'products': 'Products',
+    'total_quantity': 'Total Qty',
+    'total_taxable_value': 'Taxable Value',
+    'total_tax': 'Total Tax',
+    'total_value': 'Total Value',
+    'avg_gst_rate': 'Avg GST %'
+}
+
+MONTH_NAMES = ("January", "February", "March", "April", "May", "June",
+               "July", "August", "September", "October", "November", "December")
+
+@st.cache_data(ttl=60, show_spinner=False)
+def get_hsn_report(start_date, end_date):
+    """Get (invoice count, invoice value, HSN summary DataFrame) for invoices dated within [start_date, end_date) (cached, cleared on save/delete)"""
+    # Aggregate in the database when possible; only pull the month's invoices as a fallback
+    summary = fetch_hsn_summary(start_date, end_date)
+    if summary is not None:
+        hsn_df = pd.DataFrame(summary['hsn'], columns=list(HSN_COLUMNS)).rename(columns=HSN_COLUMNS)
+        return summary['invoice_count'], summary['invoice_total'], hsn_df.sort_values('Total Value', ascending=False)
+    
+    month_invoices = fetch_invoices_for_month(start_date, end_date)
+    total_value = sum(invoice.get('grand_total', 0) for invoice in month_invoices)
+    return len(month_invoices), total_value, build_hsn_summary(month_invoices)
+
+# Header row of the PDF items table
+PDF_ITEMS_HEADER = ('S.No', 'Product/Service', 'HSN/SAC', 'Qty', 'Rate', 'Taxable Value', 'GST', 'Amount')
+
+# PDF styles - cached as a resource because module-level code runs again on every rerun
+@st.cache_resource
+def get_pdf_styles():
+    """Build the ReportLab paragraph and table styles used by generate_pdf once per process"""
+    styles = getSampleStyleSheet()
+    return {
+        'title': ParagraphStyle('CustomTitle', parent=styles['Heading1'], fontSize=20, textColor=colors.HexColor('#1f4788'), alignment=TA_CENTER, spaceAfter=12),
+        'heading': ParagraphStyle('CustomHeading', parent=styles['Heading2'], fontSize=12, textColor=colors.HexColor('#1f4788'), spaceAfter=6),
+        'normal': styles['Normal'],
+        'right': ParagraphStyle('RightAlign', parent=styles['Normal'], alignment=TA_RIGHT),
+        # Borderless two-column layout for the company/invoice and bill/ship blocks
+        'layout_table': TableStyle([
+            ('VALIGN', (0, 0), (-1, -1), 'TOP'),
+            ('LEFTPADDING', (0, 0), (-1, -1), 0),
+            ('RIGHTPADDING', (0, 0), (-1, -1), 0),
+        ]),
+        'items_table': TableStyle([
+            ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#1f4788')),
+            ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
+            ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
+            ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
+            ('FONTSIZE', (0, 0), (-1, 0), 8),
+            ('BOTTOMPADDING', (0, 0), (-1, 0), 8),
+            ('BACKGROUND', (0, -1), (-1, -1), colors.beige),
+            ('GRID', (0, 0), (-1, -1), 1, colors.black),
+            ('FONTSIZE', (0, 1), (-1, -1), 8),
+            ('ALIGN', (3, 1), (3, -1), 'RIGHT'),
+            ('ALIGN', (4, 1), (-1, -1), 'RIGHT'),
+        ])
+    }
+
 def generate_pdf(invoice_data, company_data):
-    """Generate PDF invoice"""
+    """Generate PDF invoice and return it as bytes"""
     buffer = BytesIO()
     doc = SimpleDocTemplate(buffer, pagesize=A4, rightMargin=30, leftMargin=30, topMargin=30, bottomMargin=30)
     
     elements = []
-    styles = getSampleStyleSheet()
-    
-    # Custom styles
-    title_style = ParagraphStyle('CustomTitle', parent=styles['Heading1'], fontSize=20, textColor=colors.HexColor('#1f4788'), alignment=TA_CENTER, spaceAfter=12)
-    heading_style = ParagraphStyle('CustomHeading', parent=styles['Heading2'], fontSize=12, textColor=colors.HexColor('#1f4788'), spaceAfter=6)
-    normal_style = styles['Normal']
+    pdf_styles = get_pdf_styles()
+    title_style = pdf_styles['title']
+    heading_style = pdf_styles['heading']
+    normal_style = pdf_styles['normal']
     
     # Title
     elements.append(Paragraph("TAX INVOICE", title_style))
@@ -183,35 +380,30 @@ def generate_pdf(invoice_data, company_data):
     ]
     
     t = Table(company_invoice_data, colWidths=[3.5*inch, 2.5*inch])
-    t.setStyle(TableStyle([
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        ('LEFTPADDING', (0, 0), (-1, -1), 0),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 0),
-    ]))
+    t.setStyle(pdf_styles['layout_table'])
     elements.append(t)
     elements.append(Spacer(1, 12))
     
-    # Bill To and Ship To
-    bill_ship_data = [
-        [Paragraph("<b>Bill To:</b>", heading_style), Paragraph("<b>Ship To:</b>", heading_style)],
-        [Paragraph(f"{invoice_data['customer_name']}<br/>{invoice_data['billing_address']}<br/>GSTIN: {invoice_data.get('customer_gstin', 'N/A')}<br/>State: {invoice_data.get('customer_state', 'N/A')}", normal_style),
-         Paragraph(f"{invoice_data['customer_name']}<br/>{invoice_data['shipping_address']}", normal_style)]
-    ]
+    # Bill To and Ship To - a single block when both addresses are the same
+    bill_to = Paragraph(f"{invoice_data['customer_name']}<br/>{invoice_data['billing_address']}<br/>GSTIN: {invoice_data.get('customer_gstin', 'N/A')}<br/>State: {invoice_data.get('customer_state', 'N/A')}", normal_style)
+    if invoice_data.get('shipping_address', invoice_data['billing_address']) == invoice_data['billing_address']:
+        bill_ship_data = [[Paragraph("<b>Bill & Ship To:</b>", heading_style)], [bill_to]]
+        col_widths = [6*inch]
+    else:
+        bill_ship_data = [
+            [Paragraph("<b>Bill To:</b>", heading_style), Paragraph("<b>Ship To:</b>", heading_style)],
+            [bill_to, Paragraph(f"{invoice_data['customer_name']}<br/>{invoice_data['shipping_address']}", normal_style)]
+        ]
+        col_widths = [3*inch, 3*inch]
     
-    t = Table(bill_ship_data, colWidths=[3*inch, 3*inch])
-    t.setStyle(TableStyle([
-        ('VALIGN', (0, 0), (-1, -1), 'TOP'),
-        ('LEFTPADDING', (0, 0), (-1, -1), 0),
-        ('RIGHTPADDING', (0, 0), (-1, -1), 0),
-    ]))
+    t = Table(bill_ship_data, colWidths=col_widths)
+    t.setStyle(pdf_styles['layout_table'])
     elements.append(t)
     elements.append(Spacer(1, 12))
     
     # Items table
-    items_data = [['S.No', 'Product/Service', 'HSN/SAC', 'Qty', 'Rate', 'Taxable Value', 'GST', 'Amount']]
-    
-    for idx, item in enumerate(invoice_data['items'], 1):
-        items_data.append([
+    items_data = [PDF_ITEMS_HEADER] + [
+        (
             str(idx),
             item['product_name'],
             item['hsn_code'],
@@ -220,35 +412,25 @@ def generate_pdf(invoice_data, company_data):
             f"₹{item['taxable_value']:.2f}",
             f"{item['gst_rate']}%",
             f"₹{item['total']:.2f}"
-        ])
+        )
+        for idx, item in enumerate(invoice_data['items'], 1)
+    ]
     
     # Add totals
-    items_data.append(['', '', '', '', '', f"₹{invoice_data['subtotal']:.2f}", 'Total:', f"₹{invoice_data['subtotal']:.2f}"])
-    
     if invoice_data['is_intrastate']:
-        cgst = invoice_data['total_tax'] / 2
-        sgst = invoice_data['total_tax'] / 2
-        items_data.append(['', '', '', '', '', '', f"CGST:", f"₹{cgst:.2f}"])
-        items_data.append(['', '', '', '', '', '', f"SGST:", f"₹{sgst:.2f}"])
+        half_tax = f"₹{invoice_data['total_tax'] / 2:.2f}"
+        tax_rows = [('', '', '', '', '', '', "CGST:", half_tax), ('', '', '', '', '', '', "SGST:", half_tax)]
     else:
-        items_data.append(['', '', '', '', '', '', f"IGST:", f"₹{invoice_data['total_tax']:.2f}"])
-    
-    items_data.append(['', '', '', '', '', '', Paragraph('<b>Grand Total:</b>', normal_style), Paragraph(f"<b>₹{invoice_data['grand_total']:.2f}</b>", normal_style)])
-    
-    t = Table(items_data, colWidths=[0.5*inch, 2*inch, 0.8*inch, 0.6*inch, 0.8*inch, 1*inch, 0.8*inch, 1*inch])
-    t.setStyle(TableStyle([
-        ('BACKGROUND', (0, 0), (-1, 0), colors.HexColor('#1f4788')),
-        ('TEXTCOLOR', (0, 0), (-1, 0), colors.whitesmoke),
-        ('ALIGN', (0, 0), (-1, -1), 'CENTER'),
-        ('FONTNAME', (0, 0), (-1, 0), 'Helvetica-Bold'),
-        ('FONTSIZE', (0, 0), (-1, 0), 8),
-        ('BOTTOMPADDING', (0, 0), (-1, 0), 8),
-        ('BACKGROUND', (0, -1), (-1, -1), colors.beige),
-        ('GRID', (0, 0), (-1, -1), 1, colors.black),
-        ('FONTSIZE', (0, 1), (-1, -1), 8),
-        ('ALIGN', (3, 1), (3, -1), 'RIGHT'),
-        ('ALIGN', (4, 1), (-1, -1), 'RIGHT'),
-    ]))
+        tax_rows = [('', '', '', '', '', '', "IGST:", f"₹{invoice_data['total_tax']:.2f}")]
+    
+    items_data += [
+        ('', '', '', '', '', f"₹{invoice_data['subtotal']:.2f}", 'Total:', f"₹{invoice_data['subtotal']:.2f}"),
+        *tax_rows,
+        ('', '', '', '', '', '', Paragraph('<b>Grand Total:</b>', normal_style), Paragraph(f"<b>₹{invoice_data['grand_total']:.2f}</b>", normal_style))
+    ]
+    
+    t = Table(items_data, colWidths=[0.5*inch, 2*inch, 0.8*inch, 0.6*inch, 0.8*inch, 1*inch, 0.8*inch, 1*inch], repeatRows=1)
+    t.setStyle(pdf_styles['items_table'])
     elements.append(t)
     elements.append(Spacer(1, 12))
     
@@ -266,11 +448,23 @@ def generate_pdf(invoice_data, company_data):
     elements.append(Spacer(1, 24))
     elements.append(Paragraph("<b>Terms & Conditions:</b><br/>1. Payment due within 30 days<br/>2. Interest @18% p.a. will be charged on delayed payments", normal_style))
     elements.append(Spacer(1, 24))
-    elements.append(Paragraph(f"<b>For {company_data['name']}</b><br/><br/><br/>Authorized Signatory", ParagraphStyle('RightAlign', parent=normal_style, alignment=TA_RIGHT)))
+    elements.append(Paragraph(f"<b>For {company_data['name']}</b><br/><br/><br/>Authorized Signatory", pdf_styles['right']))
     
     doc.build(elements)
-    buffer.seek(0)
-    return buffer
+    return buffer.getvalue()
+
+@st.cache_data(show_spinner=False, max_entries=200)
+def get_invoice_pdf(invoice_data, company_data):
+    """Generate PDF invoice bytes, reusing the cached PDF when invoice and company details are unchanged"""
+    return generate_pdf(invoice_data, company_data)
+
+def get_saved_invoice_pdf(invoice_id, company_data):
+    """Get the PDF of a saved invoice, raising LookupError if it no longer exists (e.g. deleted meanwhile)"""
+    invoice = get_invoice(invoice_id)
+    if invoice is None:
+        # Streamlit reports an error raised here as a failed download instead of saving an empty file
+        raise LookupError(f"Invoice {invoice_id} no longer exists")
+    return get_invoice_pdf(invoice, company_data)
 
 # Main app
 st.title("🧾 GST Invoice Generator")
@@ -279,12 +473,15 @@ st.markdown("---")
 # Sidebar for company details
 with st.sidebar:
     st.header("⚙️ Company Details")
-    company_name = st.text_input("Company Name", "NEEDLE POINT")
-    company_address = st.text_area("Address", "First Floor, J3/70, RAJOURI GARDEN\nNew Delhi, New Delhi, Delhi, 110027")
-    company_gstin = st.text_input("GSTIN", "07AAXFN6403D1Z5")
-    company_state = st.text_input("State", "Delhi")
-    company_phone = st.text_input("Phone", "+91-9876543210")
-    company_bank = st.text_area("Bank Details (Optional)", "Bank: ICICI Bank\nA/c No: 181805001556\nIFSC: ICIC0001818\nBranch: ICICI BANK LTD, WH-9, Mayapuri Phase 1, 110044\nUPI: needlepoint.ibz@icici")
+    # Form so that editing these fields doesn't rerun the whole app until applied
+    with st.form(key="company_form"):
+        company_name = st.text_input("Company Name", "NEEDLE POINT")
+        company_address = st.text_area("Address", "First Floor, J3/70, RAJOURI GARDEN\nNew Delhi, New Delhi, Delhi, 110027")
+        company_gstin = st.text_input("GSTIN", "07AAXFN6403D1Z5")
+        company_state = st.text_input("State", "Delhi")
+        company_phone = st.text_input("Phone", "+91-9876543210")
+        company_bank = st.text_area("Bank Details (Optional)", "Bank: ICICI Bank\nA/c No: 181805001556\nIFSC: ICIC0001818\nBranch: ICICI BANK LTD, WH-9, Mayapuri Phase 1, 110044\nUPI: needlepoint.ibz@icici")
+        st.form_submit_button("✅ Apply Company Details", use_container_width=True)
 
 company_data = {
     'name': company_name,
@@ -295,91 +492,11 @@ company_data = {
     'bank_details': company_bank
 }
 
-# Main form
-tab1, tab2, tab3, tab4 = st.tabs(["📝 Create Invoice", "📊 Invoice History", "👥 Customers", "📈 HSN Analytics"])
-
-with tab1:
-    col1, col2 = st.columns([2, 1])
-    
-    with col1:
-        st.subheader("Customer Details")
-        
-        # Load existing customers
-        customers = get_customers()
-        customer_names = ["-- New Customer --"] + [c['name'] for c in customers]
-        
-        selected_customer = st.selectbox("Select Customer", customer_names)
-        
-        # Initialize variables
-        customer_name = ""
-        customer_gstin = ""
-        billing_address = ""
-        shipping_address = ""
-        customer_state = ""
-        
-        if selected_customer != "-- New Customer --":
-            customer = next((c for c in customers if c['name'] == selected_customer), None)
-            if customer:
-                customer_name = customer['name']
-                customer_gstin = customer.get('gstin', '')
-                billing_address = customer.get('billing_address', '')
-                shipping_address = customer.get('shipping_address', '')
-                customer_state = customer.get('state', '')
-                
-                # Display in text inputs (read-only style)
-                st.text_input("Customer/Company Name *", value=customer_name, key="existing_customer", disabled=True)
-                st.text_input("Customer GSTIN", value=customer_gstin, key="existing_gstin", disabled=True)
-                st.text_area("Billing Address *", value=billing_address, key="existing_billing", disabled=True)
-                st.text_area("Shipping Address *", value=shipping_address, key="existing_shipping", disabled=True)
-                st.text_input("Customer State *", value=customer_state, key="existing_state", disabled=True)
-        else:
-            customer_name = st.text_input("Customer/Company Name *", key="new_customer")
-            customer_gstin = st.text_input("Customer GSTIN (Optional)", key="new_gstin")
-            billing_address = st.text_area("Billing Address *", key="new_billing")
-            shipping_address = st.text_area("Shipping Address *", key="new_shipping")
-            customer_state = st.text_input("Customer State *", key="new_state")
-        
-        if selected_customer == "-- New Customer --":
-            if st.button("💾 Save Customer"):
-                if customer_name and billing_address:
-                    customer_data = {
-                        'name': customer_name,
-                        'gstin': customer_gstin,
-                        'billing_address': billing_address,
-                        'shipping_address': shipping_address,
-                        'state': customer_state,
-                        'created_at': datetime.now().isoformat()
-                    }
-                    if save_customer(customer_data):
-                        st.success("✅ Customer saved successfully!")
-                        st.rerun()
-    
-    with col2:
-        st.subheader("Invoice Details")
-        
-        # Get suggested invoice number
-        suggested_invoice = get_next_invoice_number()
-        
-        # Manual invoice number entry with suggestion
-        invoice_number = st.text_input(
-            "Invoice Number *", 
-            value=suggested_invoice,
-            help=f"Suggested: {suggested_invoice}. You can edit this to any value.",
-            placeholder="e.g., INV-00001, BILL-2024-001, etc."
-        )
-        
-        invoice_date = st.date_input("Invoice Date", datetime.now())
-        place_of_supply = st.text_input("Place of Supply", customer_state if 'customer_state' in locals() else "")
-        
-        # Warning if invoice number already exists
-        try:
-            existing = supabase.table('invoices').select('invoice_number').eq('invoice_number', invoice_number).execute()
-            if existing.data and len(existing.data) > 0:
-                st.warning(f"⚠️ Invoice number **{invoice_number}** already exists in the database!")
-        except:
-            pass
-    
-    st.markdown("---")
+# Item entry, totals and generation run as a fragment, so adding an item only reruns this
+# section instead of the customer lookup and the history, customers and analytics tabs
+@st.fragment
+def invoice_items_section(customer_name, customer_gstin, customer_state, billing_address, shipping_address,
+                          invoice_number, invoice_date, place_of_supply, company_data):
     st.subheader("Add Products/Services")
     
     # Create a form for better input handling
@@ -403,8 +520,6 @@ with tab1:
     
     # Handle form submission
     if submit_button:
-        st.write(f"DEBUG: Form submitted with product='{product_name}', hsn='{hsn_code}', rate={rate}")
-        
         if not product_name or not product_name.strip():
             st.error("❌ Please enter product name")
         elif not hsn_code or not hsn_code.strip():
@@ -428,22 +543,9 @@ with tab1:
                     'total': total
                 }
                 
-                st.write(f"DEBUG: Item created: {item}")
-                
-                # Initialize items list if it doesn't exist
-                if 'invoice_items' not in st.session_state:
-                    st.session_state.invoice_items = []
-                    st.write("DEBUG: Initialized empty items list")
-                
-                # Append the item
-                st.session_state.invoice_items.append(item)
-                st.write(f"DEBUG: Item appended. New count: {len(st.session_state.invoice_items)}")
+                add_invoice_item(item)
                 
                 st.success(f"✅ Added: {product_name} - ₹{total:.2f}")
-                st.balloons()
-                
-                # Rerun to refresh the page
-                st.rerun()
                 
             except Exception as e:
                 st.error(f"❌ Error adding item: {str(e)}")
@@ -474,10 +576,9 @@ with tab1:
         st.markdown("### 📦 Items Added to Invoice")
         
         try:
-            items_df = pd.DataFrame(items_list)
-            items_df['S.No'] = range(1, len(items_df) + 1)
-            items_df = items_df[['S.No', 'product_name', 'hsn_code', 'quantity', 'rate', 'taxable_value', 'gst_rate', 'tax_amount', 'total']]
-            items_df.columns = ['S.No', 'Product', 'HSN', 'Qty', 'Rate', 'Taxable Value', 'GST%', 'Tax', 'Total']
+            # Column selection returns a new frame, so the cached items DataFrame is left untouched
+            items_df = get_items_df()[list(ITEM_LABELS)].rename(columns=ITEM_LABELS)
+            items_df.insert(0, 'S.No', range(1, len(items_df) + 1))
             
             st.dataframe(items_df, use_container_width=True, hide_index=True)
         except Exception as e:
@@ -486,63 +587,17 @@ with tab1:
         
         col1, col2 = st.columns([3, 1])
         with col2:
-            if st.button("🗑️ Clear All Items", key="clear_items"):
-                st.session_state.invoice_items = []
-                st.rerun()
-        
-        st.markdown("---")
-        st.markdown("### ➕ Add More Products")
-        
-        # Show add product form even when items exist
-        col1, col2, col3, col4, col5 = st.columns([3, 2, 1, 1, 1])
-        
-        with col1:
-            extra_product = st.text_input("Product/Service Name", key="extra_product", value="")
-        with col2:
-            extra_hsn = st.text_input("HSN/SAC Code", key="extra_hsn", value="")
-        with col3:
-            extra_qty = st.number_input("Quantity", min_value=1, value=1, key="extra_qty")
-        with col4:
-            extra_rate = st.number_input("Rate (₹)", min_value=0.0, value=0.0, step=0.01, key="extra_rate")
-        with col5:
-            extra_gst = st.selectbox("GST %", [0, 5, 12, 18, 28], key="extra_gst")
-        
-        col_btn1, col_btn2, col_btn3 = st.columns([1, 1, 1])
-        with col_btn2:
-            if st.button("➕ Add Another Item", key="add_extra", use_container_width=True):
-                if extra_product and extra_hsn and extra_rate > 0:
-                    extra_taxable = extra_qty * extra_rate
-                    extra_tax = (extra_taxable * extra_gst) / 100
-                    extra_total = extra_taxable + extra_tax
-                    
-                    extra_item = {
-                        'product_name': extra_product.strip(),
-                        'hsn_code': extra_hsn.strip(),
-                        'quantity': extra_qty,
-                        'rate': extra_rate,
-                        'taxable_value': extra_taxable,
-                        'gst_rate': extra_gst,
-                        'tax_amount': extra_tax,
-                        'total': extra_total
-                    }
-                    try:
-                        st.session_state['items'].append(extra_item)
-                        st.success(f"✅ Added: {extra_product}")
-                        st.rerun()
-                    except Exception as e:
-                        st.error(f"Error: {e}")
-                else:
-                    st.error("Please fill all fields")
+            # Callback runs before the rerun the click triggers, so no explicit rerun is needed
+            st.button("🗑️ Clear All Items", key="clear_items", on_click=clear_invoice_items)
         
         st.markdown("---")
         
-        # Calculate totals
-        subtotal = sum(item['taxable_value'] for item in items_list)
-        total_tax = sum(item['tax_amount'] for item in items_list)
-        grand_total = sum(item['total'] for item in items_list)
+        # Calculate totals in one pass over the items DataFrame
+        totals = get_items_df()[['taxable_value', 'tax_amount', 'total']].sum()
+        subtotal, total_tax, grand_total = float(totals['taxable_value']), float(totals['tax_amount']), float(totals['total'])
         
         # Check if intrastate or interstate
-        is_intrastate = company_state.strip().lower() == (customer_state.strip().lower() if customer_state else '')
+        is_intrastate = company_data['state'].strip().casefold() == (customer_state or '').strip().casefold()
         
         # Display totals
         st.markdown("### 💰 Invoice Summary")
@@ -584,6 +639,20 @@ with tab1:
             else:
                 try:
                     with st.spinner('📄 Generating invoice...'):
+                        # Only draw a number from the database when the invoice is actually saved
+                        if not invoice_number:
+                            invoice_number = get_next_invoice_number()
+                        
+                        # The assigned number is never shown before saving, so make sure it is not taken
+                        try:
+                            number_taken = invoice_number_exists(invoice_number)
+                        except Exception as e:
+                            st.error(f"❌ Could not check whether invoice number **{invoice_number}** is free: {e}")
+                            return
+                        if number_taken:
+                            st.error(f"❌ Invoice number **{invoice_number}** already exists. Please enter a different invoice number.")
+                            return
+                        
                         invoice_data = {
                             'invoice_number': invoice_number,
                             'invoice_date': invoice_date.strftime('%Y-%m-%d'),
@@ -603,35 +672,20 @@ with tab1:
                         }
                         
                         # Generate PDF
-                        pdf_buffer = generate_pdf(invoice_data, company_data)
+                        pdf_buffer = get_invoice_pdf(invoice_data, company_data)
                         
-                        # Save to database
-                        save_invoice(invoice_data)
+                        # Save to database; save_invoice() has already shown the error on failure
+                        if not save_invoice(invoice_data):
+                            return
                         
                         # Store in session state
                         st.session_state['invoice_generated'] = True
                         st.session_state['pdf_buffer'] = pdf_buffer
                         st.session_state['current_invoice_number'] = invoice_number
                         st.session_state['current_invoice_date'] = invoice_date.strftime('%Y%m%d')
-                        
-                    st.success("✅ Invoice generated successfully!")
-                    st.balloons()
                     
-                    # Show download button immediately without rerun
-                    st.markdown("---")
-                    st.markdown("## 🎉 Invoice Ready!")
-                    
-                    col_a, col_b, col_c = st.columns([1, 2, 1])
-                    with col_b:
-                        st.download_button(
-                            label="📥 DOWNLOAD INVOICE PDF",
-                            data=pdf_buffer,
-                            file_name=f"Invoice_{invoice_number}_{invoice_date.strftime('%Y%m%d')}.pdf",
-                            mime="application/pdf",
-                            use_container_width=True,
-                            key="immediate_download",
-                            type="primary"
-                        )
+                    # Full rerun so the history tab and the duplicate number check pick up the new invoice
+                    st.rerun()
                     
                 except Exception as e:
                     st.error(f"❌ Error generating invoice: {str(e)}")
@@ -664,203 +718,278 @@ with tab1:
             st.write("")
             st.write("")
             
-            if st.button("🔄 Create New Invoice", use_container_width=True, key="new_invoice_btn"):
-                st.session_state.invoice_items = []
-                st.session_state['invoice_generated'] = False
-                if 'pdf_buffer' in st.session_state:
-                    del st.session_state['pdf_buffer']
-                if 'current_invoice_number' in st.session_state:
-                    del st.session_state['current_invoice_number']
-                if 'current_invoice_date' in st.session_state:
-                    del st.session_state['current_invoice_date']
-                st.rerun()
+            st.button("🔄 Create New Invoice", use_container_width=True, key="new_invoice_btn", on_click=start_new_invoice)
+
+# Main form
+tab1, tab2, tab3, tab4 = st.tabs(["📝 Create Invoice", "📊 Invoice History", "👥 Customers", "📈 HSN Analytics"])
+
+with tab1:
+    col1, col2 = st.columns([2, 1])
+    
+    with col1:
+        st.subheader("Customer Details")
+        
+        # Load existing customers, indexed by name for both the options and the selected customer lookup
+        try:
+            customers = get_customers()
+        except Exception:
+            customers = []
+        customers_by_name = {c['name']: c for c in customers}
+        customer_names = ["-- New Customer --", *customers_by_name]
+        
+        selected_customer = st.selectbox("Select Customer", customer_names)
+        
+        # Initialize variables
+        customer_name = ""
+        customer_gstin = ""
+        billing_address = ""
+        shipping_address = ""
+        customer_state = ""
+        
+        if selected_customer != "-- New Customer --":
+            customer = customers_by_name.get(selected_customer)
+            if customer:
+                customer_name = customer['name']
+                customer_gstin = customer.get('gstin', '')
+                billing_address = customer.get('billing_address', '')
+                shipping_address = customer.get('shipping_address', '')
+                customer_state = customer.get('state', '')
+                
+                # Display in text inputs (read-only style)
+                st.text_input("Customer/Company Name *", value=customer_name, key="existing_customer", disabled=True)
+                st.text_input("Customer GSTIN", value=customer_gstin, key="existing_gstin", disabled=True)
+                st.text_area("Billing Address *", value=billing_address, key="existing_billing", disabled=True)
+                st.text_area("Shipping Address *", value=shipping_address, key="existing_shipping", disabled=True)
+                st.text_input("Customer State *", value=customer_state, key="existing_state", disabled=True)
+        else:
+            customer_name = st.text_input("Customer/Company Name *", key="new_customer")
+            customer_gstin = st.text_input("Customer GSTIN (Optional)", key="new_gstin")
+            billing_address = st.text_area("Billing Address *", key="new_billing")
+            shipping_address = st.text_area("Shipping Address *", key="new_shipping")
+            customer_state = st.text_input("Customer State *", key="new_state")
+        
+        if selected_customer == "-- New Customer --":
+            if st.button("💾 Save Customer"):
+                if customer_name and billing_address:
+                    customer_data = {
+                        'name': customer_name,
+                        'gstin': customer_gstin,
+                        'billing_address': billing_address,
+                        'shipping_address': shipping_address,
+                        'state': customer_state,
+                        'created_at': datetime.now().isoformat()
+                    }
+                    if save_customer(customer_data):
+                        st.success("✅ Customer saved successfully!")
+                        st.rerun()
+    
+    with col2:
+        st.subheader("Invoice Details")
+        
+        # Manual invoice number entry; left blank, the next number is assigned on save
+        invoice_number = st.text_input(
+            "Invoice Number", 
+            help="Leave blank to auto-assign the next number (last invoice + 1) when the invoice is generated. You can also enter any value, e.g. INV-00001, BILL-2024-001.",
+            placeholder="Auto-assigned on save"
+        ).strip()
+        
+        invoice_date = st.date_input("Invoice Date", datetime.now())
+        place_of_supply = st.text_input("Place of Supply", customer_state or "")
+        
+        # Warning if invoice number already exists; a failed lookup is checked again on Generate
+        try:
+            number_taken = bool(invoice_number) and invoice_number_exists(invoice_number)
+        except Exception:
+            number_taken = False
+        if number_taken:
+            st.warning(f"⚠️ Invoice number **{invoice_number}** already exists in the database!")
+    
+    st.markdown("---")
+    invoice_items_section(customer_name, customer_gstin, customer_state, billing_address, shipping_address,
+                          invoice_number, invoice_date, place_of_supply, company_data)
 
 with tab2:
     st.subheader("📊 Invoice History")
     
-    col1, col2 = st.columns([3, 1])
+    col1, col2, col3 = st.columns([3, 1, 1])
     with col1:
-        search_term = st.text_input("🔍 Search by Invoice No or Customer Name", "")
+        search_term = st.text_input("🔍 Search by Invoice No or Customer Name", "", on_change=reset_history_page)
     with col2:
+        page = st.number_input("Page", min_value=1, step=1, key="history_page")
+    with col3:
         st.write("")
         st.write("")
         if st.button("🔄 Refresh", use_container_width=True):
+            clear_invoice_cache()
             st.rerun()
     
     try:
-        result = supabase.table('invoices').select('*').order('created_at', desc=True).execute()
-        if result.data and len(result.data) > 0:
-            invoices = result.data
+        offset = (page - 1) * HISTORY_PAGE_SIZE
+        invoices, total_invoices = fetch_invoices(offset, HISTORY_PAGE_SIZE, search_term)
+        if invoices:
+            st.caption(f"Showing {offset + 1}–{offset + len(invoices)} of {total_invoices} invoices")
             
-            # Filter if search term provided
-            if search_term:
-                invoices = [inv for inv in invoices if 
-                           search_term.lower() in inv.get('invoice_number', '').lower() or 
-                           search_term.lower() in inv.get('customer_name', '').lower()]
-            
-            if invoices:
-                # Display invoices as cards with action buttons
-                for invoice in invoices:
-                    with st.container():
-                        col1, col2, col3, col4 = st.columns([2, 2, 1, 2])
-                        
-                        with col1:
-                            st.markdown(f"**Invoice:** {invoice['invoice_number']}")
-                            st.caption(f"Date: {invoice['invoice_date']}")
+            # Display invoices as cards with action buttons
+            for invoice in invoices:
+                with st.container():
+                    col1, col2, col3, col4 = st.columns([2, 2, 1, 2])
+                    
+                    with col1:
+                        st.markdown(f"**Invoice:** {invoice['invoice_number']}")
+                        st.caption(f"Date: {invoice['invoice_date']}")
+                    
+                    with col2:
+                        st.markdown(f"**Customer:** {invoice['customer_name']}")
+                        st.caption(f"GSTIN: {invoice.get('customer_gstin', 'N/A')}")
+                    
+                    with col3:
+                        st.metric("Amount", f"₹{invoice['grand_total']:,.2f}")
+                    
+                    with col4:
+                        col_view, col_download, col_delete = st.columns(3)
                         
-                        with col2:
-                            st.markdown(f"**Customer:** {invoice['customer_name']}")
-                            st.caption(f"GSTIN: {invoice.get('customer_gstin', 'N/A')}")
+                        with col_view:
+                            if st.button("👁️", key=f"view_{invoice['id']}", use_container_width=True, help="View Invoice"):
+                                st.session_state.selected_invoice = get_invoice(invoice['id'])
+                                st.session_state.show_invoice_modal = True
                         
-                        with col3:
-                            st.metric("Amount", f"₹{invoice['grand_total']:,.2f}")
+                        with col_download:
+                            # The PDF is generated only when this row's download is clicked, not for every row
+                            st.download_button(
+                                label="📥",
+                                data=lambda invoice_id=invoice['id']: get_saved_invoice_pdf(invoice_id, company_data),
+                                file_name=f"{invoice['invoice_number']}.pdf",
+                                mime="application/pdf",
+                                key=f"download_{invoice['id']}",
+                                use_container_width=True,
+                                help="Download PDF"
+                            )
                         
-                        with col4:
-                            col_view, col_download, col_delete = st.columns(3)
-                            
-                            with col_view:
-                                if st.button("👁️", key=f"view_{invoice['id']}", use_container_width=True, help="View Invoice"):
-                                    st.session_state.selected_invoice = invoice
-                                    st.session_state.show_invoice_modal = True
-                            
-                            with col_download:
-                                # Generate PDF for download
-                                pdf_buffer = generate_pdf(invoice, company_data)
-                                st.download_button(
-                                    label="📥",
-                                    data=pdf_buffer,
-                                    file_name=f"{invoice['invoice_number']}.pdf",
-                                    mime="application/pdf",
-                                    key=f"download_{invoice['id']}",
-                                    use_container_width=True,
-                                    help="Download PDF"
-                                )
-                            
-                            with col_delete:
-                                if st.button("🗑️", key=f"delete_{invoice['id']}", use_container_width=True, help="Delete Invoice", type="secondary"):
-                                    st.session_state.delete_confirm_id = invoice['id']
-                                    st.session_state.delete_confirm_number = invoice['invoice_number']
+                        with col_delete:
+                            if st.button("🗑️", key=f"delete_{invoice['id']}", use_container_width=True, help="Delete Invoice", type="secondary"):
+                                st.session_state.delete_confirm_id = invoice['id']
+                                st.session_state.delete_confirm_number = invoice['invoice_number']
+                    
+                    # Delete confirmation dialog
+                    if st.session_state.get('delete_confirm_id') == invoice['id']:
+                        st.warning(f"⚠️ Are you sure you want to delete invoice **{st.session_state.get('delete_confirm_number')}**? This action cannot be undone!")
                         
-                        # Delete confirmation dialog
-                        if st.session_state.get('delete_confirm_id') == invoice['id']:
-                            st.warning(f"⚠️ Are you sure you want to delete invoice **{st.session_state.get('delete_confirm_number')}**? This action cannot be undone!")
-                            
-                            col_confirm, col_cancel = st.columns(2)
-                            with col_confirm:
-                                if st.button("✅ Yes, Delete", key=f"confirm_delete_{invoice['id']}", type="primary", use_container_width=True):
-                                    if delete_invoice(invoice['id']):
-                                        st.success(f"✅ Invoice {invoice['invoice_number']} deleted successfully!")
-                                        # Clear confirmation state
-                                        if 'delete_confirm_id' in st.session_state:
-                                            del st.session_state.delete_confirm_id
-                                        if 'delete_confirm_number' in st.session_state:
-                                            del st.session_state.delete_confirm_number
-                                        st.rerun()
-                                    else:
-                                        st.error("❌ Failed to delete invoice")
-                            
-                            with col_cancel:
-                                if st.button("❌ Cancel", key=f"cancel_delete_{invoice['id']}", use_container_width=True):
+                        col_confirm, col_cancel = st.columns(2)
+                        with col_confirm:
+                            if st.button("✅ Yes, Delete", key=f"confirm_delete_{invoice['id']}", type="primary", use_container_width=True):
+                                if delete_invoice(invoice['id']):
+                                    st.success(f"✅ Invoice {invoice['invoice_number']} deleted successfully!")
                                     # Clear confirmation state
                                     if 'delete_confirm_id' in st.session_state:
                                         del st.session_state.delete_confirm_id
                                     if 'delete_confirm_number' in st.session_state:
                                         del st.session_state.delete_confirm_number
                                     st.rerun()
+                                else:
+                                    st.error("❌ Failed to delete invoice")
                         
-                        st.markdown("---")
-                
-                # Invoice Detail Modal
-                if st.session_state.get('show_invoice_modal', False) and st.session_state.get('selected_invoice'):
-                    invoice = st.session_state.selected_invoice
-                    
-                    st.markdown("### 📄 Invoice Details")
-                    
-                    # Close button
-                    if st.button("✖️ Close", key="close_modal"):
-                        st.session_state.show_invoice_modal = False
-                        st.session_state.selected_invoice = None
-                        st.rerun()
-                    
-                    # Invoice header
-                    col1, col2 = st.columns(2)
-                    with col1:
-                        st.markdown(f"""
-                        **Invoice Number:** {invoice['invoice_number']}  
-                        **Date:** {invoice['invoice_date']}  
-                        **Place of Supply:** {invoice.get('place_of_supply', 'N/A')}
-                        """)
-                    
-                    with col2:
-                        st.markdown(f"""
-                        **Customer:** {invoice['customer_name']}  
-                        **GSTIN:** {invoice.get('customer_gstin', 'N/A')}  
-                        **State:** {invoice.get('customer_state', 'N/A')}
-                        """)
+                        with col_cancel:
+                            if st.button("❌ Cancel", key=f"cancel_delete_{invoice['id']}", use_container_width=True):
+                                # Clear confirmation state
+                                if 'delete_confirm_id' in st.session_state:
+                                    del st.session_state.delete_confirm_id
+                                if 'delete_confirm_number' in st.session_state:
+                                    del st.session_state.delete_confirm_number
+                                st.rerun()
                     
                     st.markdown("---")
+            
+            # Invoice Detail Modal
+            if st.session_state.get('show_invoice_modal', False) and st.session_state.get('selected_invoice'):
+                invoice = st.session_state.selected_invoice
+                
+                st.markdown("### 📄 Invoice Details")
+                
+                # Close button
+                if st.button("✖️ Close", key="close_modal"):
+                    st.session_state.show_invoice_modal = False
+                    st.session_state.selected_invoice = None
+                    st.rerun()
+                
+                # Invoice header
+                col1, col2 = st.columns(2)
+                with col1:
+                    st.markdown(f"""
+                    **Invoice Number:** {invoice['invoice_number']}  
+                    **Date:** {invoice['invoice_date']}  
+                    **Place of Supply:** {invoice.get('place_of_supply', 'N/A')}
+                    """)
+                
+                with col2:
+                    st.markdown(f"""
+                    **Customer:** {invoice['customer_name']}  
+                    **GSTIN:** {invoice.get('customer_gstin', 'N/A')}  
+                    **State:** {invoice.get('customer_state', 'N/A')}
+                    """)
+                
+                st.markdown("---")
+                
+                # Items table
+                st.markdown("#### 📦 Items")
+                items = invoice.get('items', [])
+                if items:
+                    items_df = pd.DataFrame.from_records(items, columns=list(ITEM_LABELS)).rename(columns=ITEM_LABELS)
+                    items_df.insert(0, 'S.No', range(1, len(items_df) + 1))
                     
-                    # Items table
-                    st.markdown("#### 📦 Items")
-                    items = invoice.get('items', [])
-                    if items:
-                        items_df = pd.DataFrame(items)
-                        items_df['S.No'] = range(1, len(items_df) + 1)
-                        items_df = items_df[['S.No', 'product_name', 'hsn_code', 'quantity', 'rate', 'taxable_value', 'gst_rate', 'tax_amount', 'total']]
-                        items_df.columns = ['S.No', 'Product', 'HSN', 'Qty', 'Rate (₹)', 'Taxable Value (₹)', 'GST %', 'Tax (₹)', 'Total (₹)']
-                        
-                        # Format currency columns
-                        for col in ['Rate (₹)', 'Taxable Value (₹)', 'Tax (₹)', 'Total (₹)']:
-                            items_df[col] = items_df[col].apply(lambda x: f"{x:.2f}")
-                        
-                        st.dataframe(items_df, use_container_width=True, hide_index=True)
+                    # Format currency columns for display only, leaving the values numeric
+                    items_df_styled = items_df.style.format({'Rate': '₹{:,.2f}', 'Taxable Value': '₹{:,.2f}', 'Tax': '₹{:,.2f}', 'Total': '₹{:,.2f}'})
                     
-                    # Totals
-                    col1, col2, col3 = st.columns([2, 1, 1])
-                    with col2:
+                    st.dataframe(items_df_styled, use_container_width=True, hide_index=True)
+                
+                # Totals
+                col1, col2, col3 = st.columns([2, 1, 1])
+                with col2:
+                    st.markdown(f"""
+                    **Subtotal:** ₹{invoice['subtotal']:,.2f}  
+                    """)
+                    if invoice.get('is_intrastate', True):
+                        half_tax = invoice['total_tax'] / 2
                         st.markdown(f"""
-                        **Subtotal:** ₹{invoice['subtotal']:,.2f}  
+                        **CGST:** ₹{half_tax:,.2f}  
+                        **SGST:** ₹{half_tax:,.2f}
                         """)
-                        if invoice.get('is_intrastate', True):
-                            st.markdown(f"""
-                            **CGST:** ₹{invoice['total_tax']/2:,.2f}  
-                            **SGST:** ₹{invoice['total_tax']/2:,.2f}
-                            """)
+                    else:
+                        st.markdown(f"**IGST:** ₹{invoice['total_tax']:,.2f}")
+                
+                with col3:
+                    st.markdown(f"### **Grand Total:** ₹{invoice['grand_total']:,.2f}")
+                
+                st.info(f"**Amount in Words:** {invoice.get('amount_in_words', '')}")
+                
+                st.markdown("---")
+                
+                # Download and delete buttons
+                col1, col2, col3 = st.columns([1, 1, 1])
+                
+                with col2:
+                    # Generated on click rather than every time the invoice details are shown
+                    st.download_button(
+                        label="📥 Download Invoice PDF",
+                        data=lambda inv=invoice: get_invoice_pdf(inv, company_data),
+                        file_name=f"{invoice['invoice_number']}.pdf",
+                        mime="application/pdf",
+                        key="download_modal",
+                        use_container_width=True
+                    )
+                
+                with col3:
+                    if st.button("🗑️ Delete Invoice", key="delete_modal", use_container_width=True, type="secondary"):
+                        if delete_invoice(invoice['id']):
+                            st.success(f"✅ Invoice {invoice['invoice_number']} deleted!")
+                            st.session_state.show_invoice_modal = False
+                            st.session_state.selected_invoice = None
+                            st.rerun()
                         else:
-                            st.markdown(f"**IGST:** ₹{invoice['total_tax']:,.2f}")
-                    
-                    with col3:
-                        st.markdown(f"### **Grand Total:** ₹{invoice['grand_total']:,.2f}")
-                    
-                    st.info(f"**Amount in Words:** {invoice.get('amount_in_words', '')}")
-                    
-                    st.markdown("---")
-                    
-                    # Download and delete buttons
-                    col1, col2, col3 = st.columns([1, 1, 1])
-                    
-                    with col2:
-                        pdf_buffer = generate_pdf(invoice, company_data)
-                        st.download_button(
-                            label="📥 Download Invoice PDF",
-                            data=pdf_buffer,
-                            file_name=f"{invoice['invoice_number']}.pdf",
-                            mime="application/pdf",
-                            key="download_modal",
-                            use_container_width=True
-                        )
-                    
-                    with col3:
-                        if st.button("🗑️ Delete Invoice", key="delete_modal", use_container_width=True, type="secondary"):
-                            if delete_invoice(invoice['id']):
-                                st.success(f"✅ Invoice {invoice['invoice_number']} deleted!")
-                                st.session_state.show_invoice_modal = False
-                                st.session_state.selected_invoice = None
-                                st.rerun()
-                            else:
-                                st.error("❌ Failed to delete invoice")
-            else:
-                st.info("No invoices match your search.")
+                            st.error("❌ Failed to delete invoice")
+        elif total_invoices:
+            st.info(f"No invoices on page {page}.")
+        elif search_term:
+            st.info("No invoices match your search.")
         else:
             st.info("No invoices found. Create your first invoice!")
     except Exception as e:
@@ -868,10 +997,12 @@ with tab2:
 
 with tab3:
     st.subheader("👥 Customer Database")
-    customers = get_customers()
+    try:
+        customers = get_customers()
+    except Exception:
+        customers = []
     if customers:
-        customers_df = pd.DataFrame(customers)
-        customers_df = customers_df[['name', 'gstin', 'state', 'billing_address']]
+        customers_df = pd.DataFrame.from_records(customers, columns=['name', 'gstin', 'state', 'billing_address'])
         customers_df.columns = ['Name', 'GSTIN', 'State', 'Address']
         st.dataframe(customers_df, use_container_width=True, hide_index=True)
     else:
@@ -886,11 +1017,12 @@ with tab4:
         selected_month = st.selectbox(
             "Select Month",
             options=list(range(1, 13)),
-            format_func=lambda x: datetime(2024, x, 1).strftime('%B'),
+            format_func=lambda x: MONTH_NAMES[x - 1],
             index=datetime.now().month - 1
         )
     with col2:
         selected_year = st.number_input("Year", min_value=2020, max_value=2030, value=datetime.now().year)
+    month_label = f"{MONTH_NAMES[selected_month - 1]} {selected_year}"
     
     try:
         # Fetch all invoices for the selected month
@@ -900,72 +1032,19 @@ with tab4:
         else:
             end_date = f"{selected_year}-{selected_month + 1:02d}-01"
         
-        result = supabase.table('invoices').select('*').gte('invoice_date', start_date).lt('invoice_date', end_date).execute()
+        total_invoices, total_value, hsn_df = get_hsn_report(start_date, end_date)
         
-        if result.data and len(result.data) > 0:
-            # Process invoices to extract HSN data
-            hsn_data = {}
-            total_invoices = len(result.data)
-            total_value = 0
-            
-            for invoice in result.data:
-                items = invoice.get('items', [])
-                for item in items:
-                    hsn_code = item.get('hsn_code', 'Unknown')
-                    product_name = item.get('product_name', 'Unknown')
-                    quantity = item.get('quantity', 0)
-                    taxable_value = item.get('taxable_value', 0)
-                    gst_rate = item.get('gst_rate', 0)
-                    tax_amount = item.get('tax_amount', 0)
-                    total = item.get('total', 0)
-                    
-                    if hsn_code not in hsn_data:
-                        hsn_data[hsn_code] = {
-                            'hsn_code': hsn_code,
-                            'product_names': set(),
-                            'total_quantity': 0,
-                            'total_taxable_value': 0,
-                            'total_tax': 0,
-                            'total_value': 0,
-                            'invoice_count': 0,
-                            'avg_gst_rate': []
-                        }
-                    
-                    hsn_data[hsn_code]['product_names'].add(product_name)
-                    hsn_data[hsn_code]['total_quantity'] += quantity
-                    hsn_data[hsn_code]['total_taxable_value'] += taxable_value
-                    hsn_data[hsn_code]['total_tax'] += tax_amount
-                    hsn_data[hsn_code]['total_value'] += total
-                    hsn_data[hsn_code]['avg_gst_rate'].append(gst_rate)
-                    
-                total_value += invoice.get('grand_total', 0)
-            
-            # Convert to DataFrame
-            hsn_list = []
-            for hsn, data in hsn_data.items():
-                hsn_list.append({
-                    'HSN/SAC Code': hsn,
-                    'Products': ', '.join(list(data['product_names'])[:3]) + ('...' if len(data['product_names']) > 3 else ''),
-                    'Total Qty': data['total_quantity'],
-                    'Taxable Value': data['total_taxable_value'],
-                    'Total Tax': data['total_tax'],
-                    'Total Value': data['total_value'],
-                    'Avg GST %': sum(data['avg_gst_rate']) / len(data['avg_gst_rate']) if data['avg_gst_rate'] else 0
-                })
-            
-            hsn_df = pd.DataFrame(hsn_list)
-            hsn_df = hsn_df.sort_values('Total Value', ascending=False)
-            
+        if total_invoices:
             # Display summary metrics
-            st.markdown(f"### Summary for {datetime(selected_year, selected_month, 1).strftime('%B %Y')}")
+            st.markdown(f"### Summary for {month_label}")
             
             col1, col2, col3, col4 = st.columns(4)
             with col1:
                 st.metric("Total Invoices", total_invoices)
             with col2:
-                st.metric("Unique HSN Codes", len(hsn_data))
+                st.metric("Unique HSN Codes", len(hsn_df))
             with col3:
-                st.metric("Total Taxable Value", f"₹{sum(d['total_taxable_value'] for d in hsn_data.values()):,.2f}")
+                st.metric("Total Taxable Value", f"₹{hsn_df['Taxable Value'].sum():,.2f}")
             with col4:
                 st.metric("Total Invoice Value", f"₹{total_value:,.2f}")
             
@@ -974,20 +1053,15 @@ with tab4:
             # Display HSN-wise breakdown
             st.markdown("### HSN/SAC Code Breakdown")
             
-            # Format currency columns
-            hsn_df_display = hsn_df.copy()
-            hsn_df_display['Taxable Value'] = hsn_df_display['Taxable Value'].apply(lambda x: f"₹{x:,.2f}")
-            hsn_df_display['Total Tax'] = hsn_df_display['Total Tax'].apply(lambda x: f"₹{x:,.2f}")
-            hsn_df_display['Total Value'] = hsn_df_display['Total Value'].apply(lambda x: f"₹{x:,.2f}")
-            hsn_df_display['Avg GST %'] = hsn_df_display['Avg GST %'].apply(lambda x: f"{x:.1f}%")
+            # Format currency columns for display only, leaving hsn_df numeric
+            hsn_df_display = hsn_df.style.format({'Taxable Value': '₹{:,.2f}', 'Total Tax': '₹{:,.2f}', 'Total Value': '₹{:,.2f}', 'Avg GST %': '{:.1f}%'})
             
             st.dataframe(hsn_df_display, use_container_width=True, hide_index=True)
             
-            # Download button
-            csv = hsn_df.to_csv(index=False)
+            # Download button - the CSV is only written when the button is clicked
             st.download_button(
                 label="📥 Download HSN Report (CSV)",
-                data=csv,
+                data=lambda: hsn_df.to_csv(index=False),
                 file_name=f"HSN_Report_{selected_year}_{selected_month:02d}.csv",
                 mime="text/csv"
             )
@@ -996,15 +1070,14 @@ with tab4:
             st.markdown("---")
             st.markdown("### Top 10 HSN Codes by Value")
             
-            top_10 = hsn_df.head(10).copy()
-            top_10['Total Value'] = top_10['Total Value'].apply(lambda x: float(x.replace('₹', '').replace(',', '')) if isinstance(x, str) else x)
+            # hsn_df is numeric and already sorted by Total Value, highest first
+            top_10 = hsn_df.head(10)[['HSN/SAC Code', 'Total Value']]
             
-            import plotly.express as px
             fig = px.bar(
                 top_10,
                 x='HSN/SAC Code',
                 y='Total Value',
-                title=f'Top 10 HSN Codes - {datetime(selected_year, selected_month, 1).strftime("%B %Y")}',
+                title=f'Top 10 HSN Codes - {month_label}',
                 labels={'Total Value': 'Total Value (₹)'},
                 text='Total Value'
             )
@@ -1013,7 +1086,7 @@ with tab4:
             st.plotly_chart(fig, use_container_width=True)
             
         else:
-            st.info(f"No invoices found for {datetime(selected_year, selected_month, 1).strftime('%B %Y')}")
+            st.info(f"No invoices found for {month_label}")
     
     except Exception as e:
         st.error(f"Error loading HSN analytics: {e}")
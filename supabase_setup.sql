@@ -0,0 +1,95 @@
+-- Database objects used by InvoiceApp.py on top of the customers and invoices tables.
+-- Run this in the Supabase SQL editor.
+
+-- Required: save_customer() upserts on the customer name.
+-- Wrapped so that re-running this file skips the constraint once it exists.
+do $$
+begin
+  alter table customers add constraint customers_name_key unique (name);
+exception
+  when duplicate_table or duplicate_object then null;
+end $$;
+
+-- Required: invoice numbers are unique, so a number handed out twice fails the insert
+-- instead of silently creating a second invoice with the same number.
+-- Resolve any existing duplicates (select invoice_number from invoices group by 1 having count(*) > 1) first.
+do $$
+begin
+  alter table invoices add constraint invoices_invoice_number_key unique (invoice_number);
+exception
+  when duplicate_table or duplicate_object then null;
+end $$;
+
+-- Optional: HSN Analytics aggregates a month in the database with this function.
+-- Without it the app downloads the month's invoices and aggregates them itself.
+create or replace function hsn_monthly_summary(start_date date, end_date date)
+returns jsonb
+language sql
+stable
+as $$
+  with month_invoices as (
+    select grand_total, items::jsonb as items
+    from invoices
+    -- Compare the column itself (a date, like the app's fallback query) so idx_invoices_invoice_date is usable
+    where invoice_date >= start_date and invoice_date < end_date
+  ),
+  month_items as (
+    select
+      coalesce(item->>'hsn_code', 'Unknown') as hsn_code,
+      coalesce(item->>'product_name', 'Unknown') as product_name,
+      coalesce((item->>'quantity')::numeric, 0) as quantity,
+      coalesce((item->>'taxable_value')::numeric, 0) as taxable_value,
+      coalesce((item->>'gst_rate')::numeric, 0) as gst_rate,
+      coalesce((item->>'tax_amount')::numeric, 0) as tax_amount,
+      coalesce((item->>'total')::numeric, 0) as total
+    from month_invoices,
+      jsonb_array_elements(case when jsonb_typeof(items) = 'array' then items else '[]'::jsonb end) as item
+  ),
+  hsn as (
+    select
+      hsn_code,
+      array_to_string((array_agg(distinct product_name))[1:3], ', ')
+        || case when count(distinct product_name) > 3 then '...' else '' end as products,
+      sum(quantity) as total_quantity,
+      sum(taxable_value) as total_taxable_value,
+      sum(tax_amount) as total_tax,
+      sum(total) as total_value,
+      avg(gst_rate) as avg_gst_rate
+    from month_items
+    group by hsn_code
+  )
+  select jsonb_build_object(
+    'invoice_count', (select count(*) from month_invoices),
+    'invoice_total', (select coalesce(sum(grand_total), 0) from month_invoices),
+    'hsn', coalesce((select jsonb_agg(hsn) from hsn), '[]'::jsonb)
+  );
+$$;
+
+-- Optional: index for the month range filters of HSN Analytics (hsn_monthly_summary and the
+-- fallback fetch), so a month is read with an index range scan instead of a full table scan.
+-- Use "create index concurrently" instead on a busy database (it cannot run in a transaction).
+create index if not exists idx_invoices_invoice_date on invoices (invoice_date);
+
+-- Optional: index for the Invoice History page query (newest first, one page at a time),
+-- so Postgres reads the first rows of the index instead of sorting the whole table.
+create index if not exists idx_invoices_created_at on invoices (created_at desc);
+
+-- Optional: trigram indexes for the Invoice History search (ilike '%term%')
+create extension if not exists pg_trgm;
+create index if not exists idx_invoices_invoice_number_trgm on invoices using gin (invoice_number gin_trgm_ops);
+create index if not exists idx_invoices_customer_name_trgm on invoices using gin (customer_name gin_trgm_ops);
+
+-- Optional: atomic invoice numbering (INV-00001, INV-00002, ...) in one round-trip.
+-- Without it the next number is derived from the last saved invoice, which can give
+-- two users saving at the same moment the same number.
+create sequence if not exists invoice_seq start 1;
+
+-- Continue after the highest number already used, so existing invoices are never handed out again
+select setval('invoice_seq', coalesce(max(substring(invoice_number from '\d+$')::bigint), 0) + 1, false) from invoices;
+
+create or replace function next_invoice_number()
+returns text
+language sql
+as $$
+  select 'INV-' || lpad(nextval('invoice_seq')::text, 5, '0');
+$$;